@@ -1,734 +1,815 @@
 import os
-
-import json
-
+import secrets
+import hashlib
 import asyncio
-
 import logging
-
-from datetime import datetime, timedelta, timezone
-
+import logging.handlers
+import queue
+import atexit
+import weakref
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
 from typing import List, Optional
 
-
-
 # Third-party imports
-
 from fastapi import FastAPI, Request, HTTPException
-
-from fastapi.responses import JSONResponse
-
+from fastapi.responses import ORJSONResponse
+import orjson
 import uvicorn
-
+import asyncpg
 import stripe
-
+from cachetools import TTLCache
+from aiolimiter import AsyncLimiter
 from dotenv import load_dotenv
-
 from supabase import create_client, Client
-
 from groq import AsyncGroq
-
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup
-
+from telegram.error import RetryAfter
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
-
 import httpx
 
-
-
 # Load Environment Variables
-
 load_dotenv()
 
-
-
 # --- CONFIGURATION ---
-
 TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
-
+TELEGRAM_WEBHOOK_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET") # Webhook path segment and secret token (A-Z, a-z, 0-9, _ and -)
+PUBLIC_URL = os.getenv("PUBLIC_URL") # Public https base URL of this server
 SUPABASE_URL = os.getenv("SUPABASE_URL")
-
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
-
+DATABASE_URL = os.getenv("DATABASE_URL") # Postgres DSN for the hot path (Supavisor pooler, port 5432 or 6543)
+SUPABASE_POOL_LIMIT = int(os.getenv("SUPABASE_POOL_LIMIT", "60")) # Max client connections the plan allows
 GROQ_API_KEY = os.getenv("GROQ_API_KEY")
-
 RUNPOD_API_KEY = os.getenv("RUNPOD_API_KEY")
-
 RUNPOD_ENDPOINT_ID = os.getenv("RUNPOD_ENDPOINT_ID")
-
+RUNPOD_CONFIGURED = bool(RUNPOD_ENDPOINT_ID and RUNPOD_API_KEY)
 STRIPE_KEY = os.getenv("STRIPE_SECRET_KEY")
-
 STRIPE_WEBHOOK_SECRET = os.getenv("STRIPE_WEBHOOK_SECRET")
+# IMPORTANT: Replace the url below with your real Stripe Payment Link
+STRIPE_PAYMENT_LINK = "https://buy.stripe.com/test_12345"
 
-
+# Leave headroom under the plan's connection cap for the dashboard, migrations, etc.
+DB_POOL_MAX_SIZE = max(1, min(50, SUPABASE_POOL_LIMIT - 5))
 
 # Limits
-
 FREE_MSG_LIMIT = 10
-
 FREE_IMG_LIMIT = 3
-
-
+MAX_HISTORY = 20 # Chat turns kept per session
+GROQ_HISTORY_WINDOW = 8 # Most recent turns sent to Groq; older ones are folded into the session summary
+# The summary is refreshed every 3rd message, i.e. every 6 turns (user + assistant). Each refresh covers all
+# but the last 2 turns, which is everything that will have slid out of the window before the next refresh.
+SUMMARY_REFRESH_TURNS = 6
+SUMMARY_KEEP_TURNS = GROQ_HISTORY_WINDOW - SUMMARY_REFRESH_TURNS
+
+# In-process caches (cache-aside) for data that rarely changes
+CHARACTER_CACHE = TTLCache(maxsize=1, ttl=300) # "v1:char:all" -> list of characters
+CHARACTER_BY_ID = TTLCache(maxsize=1024, ttl=600) # character id -> character row (immutable per session)
+PROMPT_CACHE = TTLCache(maxsize=1024, ttl=600) # (character id, style) -> full system message
+PREMIUM_CACHE = TTLCache(maxsize=10_000, ttl=60) # "v1:user:{id}:premium" -> bool
+RESPONSE_CACHE = TTLCache(maxsize=10_000, ttl=3600) # "v1:resp:{char}:{style}:{hash}" -> opening reply
+IMAGE_CACHE = TTLCache(maxsize=10_000, ttl=86400 * 7) # "v1:img:{style}:{lora}:{hash}" -> RunPod image URL
+INFLIGHT: dict[str, asyncio.Task] = {} # Cache key -> pending fetch, so concurrent misses share one call
+
+# Background work (image generation, history summaries) spawned from handlers
+BG_TASKS: set[asyncio.Task] = set() # Strong refs so running tasks aren't garbage collected
+RUNPOD_SEMAPHORE = asyncio.Semaphore(20) # Caps concurrent outbound RunPod calls
+
+# One lock per user serializes their messages and session changes; entries vanish once no handler holds or awaits them
+USER_LOCKS: "weakref.WeakValueDictionary[int, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+# Telegram flood limits: ~30 msg/s per bot, ~1 msg/s per chat
+TELEGRAM_GLOBAL_RATE = 30
+TELEGRAM_CHAT_INTERVAL = 1.0
+TELEGRAM_MAX_RETRIES = 3
 
 # Setup Clients
-
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
-
+supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY) # Only the Stripe webhook still goes through REST
 groq_client = AsyncGroq(api_key=GROQ_API_KEY)
-
 stripe.api_key = STRIPE_KEY
-
-app = FastAPI()
-
-
-
-# Logging
-
-logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
-
+db_pool: Optional[asyncpg.Pool] = None # Created once at startup (see lifespan)
+http_client: Optional[httpx.AsyncClient] = None # Shared keep-alive client for RunPod (see lifespan)
+bot_app: Optional[Application] = None # Telegram Application, fed by the webhook route (see lifespan)
+
+# Logging (handlers only enqueue; a background thread does the formatting and stderr writes)
+log_queue = queue.SimpleQueue()
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+log_listener = logging.handlers.QueueListener(log_queue, log_handler)
+logging.basicConfig(level=logging.INFO, handlers=[logging.handlers.QueueHandler(log_queue)])
+log_listener.start()
+atexit.register(log_listener.stop) # Flush whatever is still queued on exit
 logger = logging.getLogger(__name__)
 
 
-
 # --- DATABASE HELPERS ---
 
+SESSION_COLUMNS = "character_id, current_style, chat_history, msg_counter, summary"
 
+# Appends the jsonb object in $2 to chat_history, dropping the oldest entry once full
+APPEND_HISTORY_SQL = f"""
+    chat_history = (CASE WHEN jsonb_array_length(chat_history) >= {MAX_HISTORY}
+                         THEN chat_history - 0 ELSE chat_history END) || $2::jsonb
+"""
 
-async def get_or_create_user(user_id, username, first_name):
 
-data = supabase.table("users").select("*").eq("telegram_id", user_id).execute()
+def orjson_text(value):
+    # asyncpg's text codecs expect str; orjson produces bytes
+    return orjson.dumps(value).decode()
 
-if not data.data:
 
-new_user = {
+async def init_db_connection(conn):
+    # Encode/decode json/jsonb columns (chat_history and appended turns) as Python objects
+    for pg_type in ("json", "jsonb"):
+        await conn.set_type_codec(pg_type, encoder=orjson_text, decoder=orjson.loads, schema="pg_catalog")
 
-"telegram_id": user_id,
-
-"username": username,
-
-"first_name": first_name,
-
-"daily_msg_count": 0,
-
-"daily_img_count": 0
-
-}
-
-supabase.table("users").insert(new_user).execute()
-
-return new_user
-
-
-# Check Daily Reset
-
-user = data.data[0]
-
-last_reset = datetime.fromisoformat(user['last_reset_time'].replace('Z', '+00:00'))
-
-if datetime.now(timezone.utc) - last_reset > timedelta(hours=24):
-
-supabase.table("users").update({
-
-"daily_msg_count": 0,
-
-"daily_img_count": 0,
-
-"last_reset_time": datetime.now(timezone.utc).isoformat()
-
-}).eq("telegram_id", user_id).execute()
-
-user['daily_msg_count'] = 0
-
-user['daily_img_count'] = 0
-
-return user
 
+async def get_or_create_user(user_id, username, first_name):
+    # One round-trip: insert new users, apply the 24h daily reset server-side, else return the row as is.
+    # Exactly one branch yields the row, so no ordering is needed; no write happens unless a reset is due.
+    query = """
+        WITH ins AS (
+            INSERT INTO users (telegram_id, username, first_name, daily_msg_count, daily_img_count, last_reset_time)
+            VALUES ($1, $2, $3, 0, 0, now())
+            ON CONFLICT (telegram_id) DO NOTHING
+            RETURNING *
+        ), upd AS (
+            UPDATE users SET daily_msg_count = 0, daily_img_count = 0, last_reset_time = now()
+            WHERE telegram_id = $1 AND last_reset_time < now() - interval '24 hours'
+            RETURNING *
+        )
+        SELECT * FROM ins
+        UNION ALL SELECT * FROM upd
+        UNION ALL SELECT * FROM users
+            WHERE telegram_id = $1 AND NOT EXISTS (SELECT 1 FROM ins) AND NOT EXISTS (SELECT 1 FROM upd)
+    """
+    row = await db_pool.fetchrow(query, user_id, username, first_name)
+    if row is None:
+        # A concurrent first contact inserted the user after our snapshot was taken; it's visible now
+        row = await db_pool.fetchrow(query, user_id, username, first_name)
+    return dict(row)
+
+
+async def get_characters():
+    chars = CHARACTER_CACHE.get("v1:char:all")
+    if chars is None:
+        chars = [dict(row) for row in await db_pool.fetch("SELECT * FROM characters")]
+        CHARACTER_CACHE["v1:char:all"] = chars
+        CHARACTER_BY_ID.update((c['id'], c) for c in chars)
+    return chars
+
+
+async def get_character(character_id):
+    char = CHARACTER_BY_ID.get(character_id)
+    if char is None:
+        row = await db_pool.fetchrow("SELECT * FROM characters WHERE id = $1", character_id)
+        char = CHARACTER_BY_ID[character_id] = dict(row)
+    return char
+
+
+def premium_cache_key(user_id):
+    return f"v1:user:{user_id}:premium"
+
+
+async def is_premium_user(user_id):
+    key = premium_cache_key(user_id)
+    is_premium = PREMIUM_CACHE.get(key)
+    if is_premium is None:
+        is_premium = bool(await db_pool.fetchval("SELECT is_premium FROM users WHERE telegram_id = $1", user_id))
+        PREMIUM_CACHE[key] = is_premium
+    return is_premium
+
+
+async def with_character(row):
+    # Only the mutable session columns come from the DB; the character is served from cache
+    if not row:
+        return None
+    session = dict(row)
+    session['characters'] = await get_character(session['character_id'])
+    return session
 
 
 async def get_active_session(user_id):
-
-data = supabase.table("active_sessions").select("*, characters(*)").eq("user_id", user_id).execute()
-
-return data.data[0] if data.data else None
-
+    row = await db_pool.fetchrow(f"SELECT {SESSION_COLUMNS} FROM active_sessions WHERE user_id = $1", user_id)
+    return await with_character(row)
+
+
+async def record_user_message(user_id, text):
+    # One round-trip per inbound message: append the user turn (keeping the last MAX_HISTORY),
+    # advance the image counter (wraps every 3rd message) and bump the daily message count.
+    # Returns the updated session with its character, or None if there is no active session.
+    row = await db_pool.fetchrow(
+        f"""
+        WITH s AS (
+            UPDATE active_sessions
+            SET {APPEND_HISTORY_SQL},
+                msg_counter = (msg_counter + 1) % 3
+            WHERE user_id = $1
+            RETURNING {SESSION_COLUMNS}
+        ), u AS (
+            UPDATE users SET daily_msg_count = daily_msg_count + 1
+            WHERE telegram_id = $1 AND EXISTS (SELECT 1 FROM s)
+        )
+        SELECT * FROM s
+        """,
+        user_id, {"role": "user", "content": text}
+    )
+    return await with_character(row)
+
+
+async def start_session(user_id, character_id, current_style, chat_history):
+    # Replaces any existing session in one upsert (relies on the unique active_sessions.user_id)
+    await db_pool.execute(
+        """
+        INSERT INTO active_sessions (user_id, character_id, current_style, chat_history, msg_counter, summary)
+        VALUES ($1, $2, $3, $4, 0, NULL)
+        ON CONFLICT (user_id) DO UPDATE SET
+            character_id = EXCLUDED.character_id,
+            current_style = EXCLUDED.current_style,
+            chat_history = EXCLUDED.chat_history,
+            msg_counter = 0,
+            summary = NULL
+        """,
+        user_id, character_id, current_style, chat_history
+    )
+
+
+async def create_checkpoint(user_id, session, name):
+    await db_pool.execute(
+        "INSERT INTO checkpoints (user_id, character_id, checkpoint_name, chat_history, current_style) "
+        "VALUES ($1, $2, $3, $4, $5)",
+        user_id, session['character_id'], name, session['chat_history'], session['current_style']
+    )
+
+
+async def get_checkpoints(user_id):
+    return await db_pool.fetch(
+        "SELECT id, checkpoint_name, current_style FROM checkpoints WHERE user_id = $1 ORDER BY created_at DESC",
+        user_id
+    )
+
+
+async def get_checkpoint(user_id, checkpoint_id):
+    # checkpoint_id comes from callback data as text; user_id scopes the lookup to the caller's own saves
+    row = await db_pool.fetchrow(
+        "SELECT * FROM checkpoints WHERE user_id = $1 AND id::text = $2",
+        user_id, checkpoint_id
+    )
+    return dict(row) if row else None
 
 
 async def update_chat_history(user_id, role, content):
-
-session = await get_active_session(user_id)
-
-if not session: return
-
-
-history = session['chat_history']
-
-history.append({"role": role, "content": content})
-
-
-# Keep history manageable (last 20 messages)
-
-if len(history) > 20: history = history[-20:]
-
-
-supabase.table("active_sessions").update({"chat_history": history}).eq("user_id", user_id).execute()
-
-return history
-
+    # Atomic in-database append: no read-modify-write, only the new turn goes over the wire
+    await db_pool.execute(
+        f"UPDATE active_sessions SET {APPEND_HISTORY_SQL} WHERE user_id = $1",
+        user_id, {"role": role, "content": content}
+    )
 
 
 # --- AI & IMAGE LOGIC ---
 
-
-
-async def generate_response(history, system_prompt, style):
-
-messages = [{"role": "system", "content": f"{system_prompt}. Style: {style}"}] + history
-
-try:
-
-chat_completion = await groq_client.chat.completions.create(
-
-messages=messages,
-
-model="llama-3.3-70b-versatile", # High quality, fast
-
-temperature=0.7,
-
-max_tokens=300,
-
-)
-
-return chat_completion.choices[0].message.content
-
-except Exception as e:
-
-logger.error(f"Groq Error: {e}")
-
-return "I'm having a little trouble thinking right now, darling..."
-
+def text_hash(text):
+    return hashlib.blake2b(text.lower().strip().encode(), digest_size=8).hexdigest()
+
+
+def response_cache_key(character_id, style, text):
+    return f"v1:resp:{character_id}:{style}:{text_hash(text)}"
+
+
+_MISSING = object()
+
+
+async def cache_aside(cache, key, fetch):
+    """Returns cache[key], calling fetch() on a miss; concurrent misses wait on the same call.
+    A None result (failure) is not cached."""
+    # Single lookup: a TTL entry can expire between an `in` check and the read
+    value = cache.get(key, _MISSING)
+    if value is not _MISSING:
+        return value
+
+    task = INFLIGHT.get(key)
+    if task is None:
+        task = INFLIGHT[key] = asyncio.create_task(fetch())
+        task.add_done_callback(lambda _: INFLIGHT.pop(key, None))
+    value = await asyncio.shield(task)
+    if value is not None:
+        cache[key] = value
+    return value
+
+
+async def _groq_reply(messages, model="llama-3.3-70b-versatile", max_tokens=300):
+    try:
+        chat_completion = await groq_client.chat.completions.create(
+            messages=messages,
+            model=model, # Default is high quality, fast
+            temperature=0.7,
+            max_tokens=max_tokens,
+        )
+        return chat_completion.choices[0].message.content
+    except Exception as e:
+        logger.error(f"Groq Error: {e}")
+        return None
+
+
+def get_system_prompt(char, style):
+    # Constant for a given (character, style), so build it once rather than on every message
+    key = (char['id'], style)
+    prompt = PROMPT_CACHE.get(key)
+    if prompt is None:
+        # FIX: Force short, seductive responses with emojis
+        prompt = PROMPT_CACHE[key] = "".join((
+            char['system_prompt'], ". ",
+            "Current Style: ", style, ". ",
+            "IMPORTANT: Keep your reply SHORT (under 2 sentences). ",
+            "Be seductive, flirty, and use emojis like 😘, 😉, 🔥.",
+            ". Style: ", style,
+        ))
+    return prompt
+
+
+async def generate_response(history, system_prompt, summary=None, cache_key=None):
+    # Only the tail of the history goes to Groq; the summary stands in for older turns.
+    # Without a summary yet (restored checkpoint, pre-summary session) send the whole (MAX_HISTORY-capped) history
+    messages = [{"role": "system", "content": system_prompt}]
+    if not summary:
+        messages += history
+    else:
+        if len(history) > GROQ_HISTORY_WINDOW:
+            messages.append({"role": "system", "content": f"Summary of the earlier conversation: {summary}"})
+        messages += history[-GROQ_HISTORY_WINDOW:]
+    if cache_key:
+        reply = await cache_aside(RESPONSE_CACHE, cache_key, lambda: _groq_reply(messages))
+    else:
+        reply = await _groq_reply(messages)
+    return reply or "I'm having a little trouble thinking right now, darling..."
+
+
+async def summarize_history(user_id, session):
+    # Folds all but the newest SUMMARY_KEEP_TURNS turns (plus the previous summary) into active_sessions.summary
+    history, summary = session['chat_history'], session['summary']
+    older = history[:len(history) - SUMMARY_KEEP_TURNS]
+    transcript = "\n".join(f"{turn['role']}: {turn['content']}" for turn in older)
+    if summary:
+        transcript = f"Earlier summary: {summary}\n{transcript}"
+    try:
+        new_summary = await _groq_reply(
+            [
+                {"role": "system", "content": "Summarize this conversation in 2 sentences. Keep names, facts and preferences the user shared."},
+                {"role": "user", "content": transcript},
+            ],
+            model="llama-3.1-8b-instant",
+            max_tokens=120,
+        )
+        if new_summary:
+            # Only write into the conversation that was summarized: skip if the user has since picked a
+            # character or restored a checkpoint (start_session), or a newer summary already landed
+            await db_pool.execute(
+                "UPDATE active_sessions SET summary = $2 "
+                "WHERE user_id = $1 AND character_id = $3 AND summary IS NOT DISTINCT FROM $4 "
+                "AND chat_history @> $5::jsonb",
+                user_id, new_summary, session['character_id'], summary, [history[-1]]
+            )
+    except Exception as e:
+        logger.error(f"Summary Error: {e}")
 
 
 async def generate_image(prompt, style, lora_key):
+    # This sends a request to RunPod ComfyUI
+    if not RUNPOD_CONFIGURED:
+        return None # Skip if not configured
+
+    # Image URLs stay valid for days, so identical prompts reuse the last render
+    key = f"v1:img:{style}:{lora_key}:{text_hash(prompt)}"
+    return await cache_aside(IMAGE_CACHE, key, lambda: _runpod_image(prompt, style, lora_key))
+
+
+async def _runpod_image(prompt, style, lora_key):
+    url = f"https://api.runpod.ai/v2/{RUNPOD_ENDPOINT_ID}/runsync"
+
+    # Simplified ComfyUI Payload
+    payload = {
+        "input": {
+            "prompt": f"{style} style, {prompt}, masterpiece, best quality",
+            "lora": lora_key
+        }
+    }
+
+    headers = {"Authorization": f"Bearer {RUNPOD_API_KEY}", "Content-Type": "application/json"}
+
+    async with RUNPOD_SEMAPHORE:
+        try:
+            resp = await http_client.post(url, content=orjson.dumps(payload), headers=headers)
+            data = orjson.loads(resp.content)
+            # Assuming RunPod returns an image URL in output['output']['images'][0]
+            if 'output' in data and 'images' in data['output']:
+                return data['output']['images'][0]
+        except Exception as e:
+            logger.error(f"Image Gen Error: {e}")
+    return None
+
+
+def spawn_background(coro):
+    task = asyncio.create_task(coro)
+    BG_TASKS.add(task)
+    task.add_done_callback(BG_TASKS.discard)
+    return task
+
+
+async def _maybe_send_image(bot, chat_id, response_text, session, user_data):
+    # Runs off the handler so a slow RunPod call never holds up the Telegram update
+    user_id = user_data['telegram_id']
+    reserved = delivered = False
+    try:
+        # Reserve the quota before the slow RunPod call so overlapping tasks can't all pass the check
+        reserved = bool(await db_pool.fetchval(
+            "UPDATE users SET daily_img_count = daily_img_count + 1 "
+            "WHERE telegram_id = $1 AND (is_premium OR daily_img_count < $2) RETURNING 1",
+            user_id, FREE_IMG_LIMIT
+        ))
+        if not reserved:
+            return
+
+        await tg_call(chat_id, bot.send_chat_action, chat_id=chat_id, action="upload_photo", paced=False)
+        img_url = await generate_image(response_text, session['current_style'], session['characters']['image_lora_key'])
+        if img_url:
+            await tg_call(chat_id, bot.send_photo, chat_id=chat_id, photo=img_url)
+            delivered = True
+    except Exception as e:
+        logger.error(f"Background Image Error: {e}")
+    finally:
+        if reserved and not delivered:
+            # Nothing reached the user (no image, or Telegram rejected it), so hand the reserved image back
+            try:
+                await db_pool.execute(
+                    "UPDATE users SET daily_img_count = GREATEST(daily_img_count - 1, 0) WHERE telegram_id = $1", user_id
+                )
+            except Exception as e:
+                logger.error(f"Image Refund Error: {e}")
+
+
+# --- STATIC MENUS (built once at import, shared by every handler call) ---
+
+START_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Choose Character 👩", callback_data="menu_chars")],
+    [InlineKeyboardButton("My Checkpoints 💾", callback_data="menu_checkpoints")],
+    [InlineKeyboardButton("Upgrade to Premium 💎", callback_data="menu_premium")]
+])
+LIMIT_KEYBOARD = InlineKeyboardMarkup([[InlineKeyboardButton("💎 Upgrade Now", callback_data="menu_premium")]])
+PREMIUM_KEYBOARD = InlineKeyboardMarkup([[InlineKeyboardButton("💳 Click to Pay $9.99", url=STRIPE_PAYMENT_LINK)]])
+PREMIUM_TEXT = (
+    "💎 **Premium Access**\n\n"
+    "🔥 Unlimited Messages\n"
+    "📸 Unlimited Photos\n"
+    "🔓 Unlock Raven (Goth Girl)\n\n"
+    "Click below to upgrade:"
+)
 
-# This sends a request to RunPod ComfyUI
-
-if not RUNPOD_ENDPOINT_ID or not RUNPOD_API_KEY:
-
-return None # Skip if not configured
-
-
-url = f"https://api.runpod.ai/v2/{RUNPOD_ENDPOINT_ID}/runsync"
-
-
-# Simplified ComfyUI Payload
-
-payload = {
-
-"input": {
-
-"prompt": f"{style} style, {prompt}, masterpiece, best quality",
-
-"lora": lora_key
-
-}
-
-}
-
-
-headers = {"Authorization": f"Bearer {RUNPOD_API_KEY}"}
-
-
-async with httpx.AsyncClient() as client:
-
-try:
-
-resp = await client.post(url, json=payload, headers=headers, timeout=60)
-
-data = resp.json()
-
-# Assuming RunPod returns an image URL in output['output']['images'][0]
-
-if 'output' in data and 'images' in data['output']:
-
-return data['output']['images'][0]
-
-except Exception as e:
-
-logger.error(f"Image Gen Error: {e}")
-
-return None
 
+# --- TELEGRAM RATE LIMITING ---
+
+class TelegramRateLimiter:
+    """Paces outbound Telegram calls to stay under the bot-wide and per-chat flood limits"""
+
+    def __init__(self, global_rate, chat_interval):
+        self.global_limiter = AsyncLimiter(global_rate, 1)
+        self.chat_interval = chat_interval
+        # A lock lives exactly as long as someone holds or awaits it (a TTL would drop locks still in use)
+        self.chat_locks = weakref.WeakValueDictionary()
+        # Send times only matter within the pacing window, so let idle chats expire
+        self.last_sent = TTLCache(maxsize=10_000, ttl=60)
+
+    @asynccontextmanager
+    async def acquire(self, chat_id, paced=True):
+        # Chat actions ("typing") skip per-chat pacing; they aren't messages and shouldn't delay the reply
+        if not paced:
+            async with self.global_limiter:
+                yield
+            return
+
+        lock = self.chat_locks.get(chat_id)
+        if lock is None:
+            lock = self.chat_locks[chat_id] = asyncio.Lock()
+        async with lock:
+            loop = asyncio.get_running_loop()
+            wait = self.last_sent.get(chat_id, 0) + self.chat_interval - loop.time()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            async with self.global_limiter:
+                yield
+            self.last_sent[chat_id] = loop.time()
+
+
+telegram_limiter = TelegramRateLimiter(TELEGRAM_GLOBAL_RATE, TELEGRAM_CHAT_INTERVAL)
+
+
+async def tg_call(chat_id, method, /, *args, paced=True, **kwargs):
+    """Runs one Telegram API call through the rate limiter, waiting out flood-control 429s"""
+    for attempt in range(TELEGRAM_MAX_RETRIES + 1):
+        async with telegram_limiter.acquire(chat_id, paced=paced):
+            try:
+                return await method(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt == TELEGRAM_MAX_RETRIES:
+                    raise
+                delay = e.retry_after
+        delay = delay.total_seconds() if isinstance(delay, timedelta) else delay
+        logger.warning(f"Telegram flood control, retrying in {delay}s")
+        await asyncio.sleep(delay)
 
 
 # --- TELEGRAM HANDLERS ---
 
-
-
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    await get_or_create_user(user.id, user.username, user.first_name)
 
-user = update.effective_user
-
-await get_or_create_user(user.id, user.username, user.first_name)
-
+    await tg_call(
+        update.effective_chat.id, update.message.reply_text,
+        f"Hi {user.first_name}! I'm your AI companion. Choose a character to start!",
+        reply_markup=START_KEYBOARD
+    )
 
-keyboard = [
 
-[InlineKeyboardButton("Choose Character 👩", callback_data="menu_chars")],
+async def send_typing(bot, chat_id):
+    # Cosmetic only: a failed chat action must not cost us the Groq reply it runs alongside
+    try:
+        await tg_call(chat_id, bot.send_chat_action, chat_id=chat_id, action="typing", paced=False)
+    except Exception as e:
+        logger.warning(f"Typing Action Error: {e}")
 
-[InlineKeyboardButton("My Checkpoints 💾", callback_data="menu_checkpoints")],
-
-[InlineKeyboardButton("Upgrade to Premium 💎", callback_data="menu_premium")]
-
-]
-
-await update.message.reply_text(
-
-f"Hi {user.first_name}! I'm your AI companion. Choose a character to start!",
-
-reply_markup=InlineKeyboardMarkup(keyboard)
-
-)
 
+def user_lock(user_id):
+    lock = USER_LOCKS.get(user_id)
+    if lock is None:
+        lock = USER_LOCKS[user_id] = asyncio.Lock()
+    return lock
 
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-
-user_id = update.effective_user.id
-
-text = update.message.text
-
-
-user_data = await get_or_create_user(user_id, update.effective_user.username, update.effective_user.first_name)
-
-session = await get_active_session(user_id)
-
-
-# Check if session exists
-
-if not session:
-
-await update.message.reply_text("Please select a character first with /start")
-
-return
-
-
-
-# Check Limits (if not premium)
-
-if not user_data['is_premium']:
-
-if user_data['daily_msg_count'] >= FREE_MSG_LIMIT:
-
-# FIX: Added Upgrade Button here
-
-keyboard = [[InlineKeyboardButton("💎 Upgrade Now", callback_data="menu_premium")]]
-
-await update.message.reply_text(
-
-"Daily limit reached! 💎 You need more energy to continue.",
-
-reply_markup=InlineKeyboardMarkup(keyboard)
-
-)
-
-return
-
-
-
-# Save User Msg
-
-await update_chat_history(user_id, "user", text)
-
-
-# Generate AI Response
-
-char = session['characters']
-
-history = session['chat_history']
-
-
-await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="typing")
-
-
-# FIX: Force short, seductive responses with emojis
-
-system_instruction = (
-
-f"{char['system_prompt']}. "
-
-f"Current Style: {session['current_style']}. "
-
-"IMPORTANT: Keep your reply SHORT (under 2 sentences). "
-
-"Be seductive, flirty, and use emojis like 😘, 😉, 🔥."
-
-)
-
-
-response_text = await generate_response(history, system_instruction, session['current_style'])
-
-
-# Save Assistant Msg
-
-await update_chat_history(user_id, "assistant", response_text)
-
-
-# FIX: Send Text Response FIRST (so it feels instant)
-
-await update.message.reply_text(response_text)
-
-
-
-# Increment Counters
-
-new_msg_count = user_data['daily_msg_count'] + 1
-
-session_counter = session['msg_counter'] + 1
-
-
-supabase.table("users").update({"daily_msg_count": new_msg_count}).eq("telegram_id", user_id).execute()
-
-
-# Image Generation Logic (Runs in background now)
-
-if session_counter >= 3:
-
-session_counter = 0 # Reset
-
-if user_data['is_premium'] or user_data['daily_img_count'] < FREE_IMG_LIMIT:
-
-await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="upload_photo")
-
-# This might take a few seconds, but the user already has their text reply!
-
-img_url = await generate_image(response_text, session['current_style'], char['image_lora_key'])
-
-if img_url:
-
-await update.message.reply_photo(img_url)
-
-supabase.table("users").update({"daily_img_count": user_data['daily_img_count'] + 1}).eq("telegram_id", user_id).execute()
-
-
-supabase.table("active_sessions").update({"msg_counter": session_counter}).eq("user_id", user_id).execute()
-
+    # Rapid messages from one user are handled in order, so history and counters never interleave
+    async with user_lock(update.effective_user.id):
+        await _handle_message(update, context)
+
+
+async def _handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    chat_id = update.effective_chat.id
+    text = update.message.text
+
+    user_data = await get_or_create_user(user_id, update.effective_user.username, update.effective_user.first_name)
+
+    # Check Limits (if not premium)
+    if not user_data['is_premium']:
+        if user_data['daily_msg_count'] >= FREE_MSG_LIMIT:
+            # FIX: Added Upgrade Button here
+            await tg_call(
+                chat_id, update.message.reply_text,
+                "Daily limit reached! 💎 You need more energy to continue.",
+                reply_markup=LIMIT_KEYBOARD
+            )
+            return
+
+    # Save User Msg (also bumps the msg/image counters)
+    session = await record_user_message(user_id, text)
+
+    # Check if session exists
+    if not session:
+        await tg_call(chat_id, update.message.reply_text, "Please select a character first with /start")
+        return
+
+    # Generate AI Response
+    char = session['characters']
+    history = session['chat_history']
+
+    system_prompt = get_system_prompt(char, session['current_style'])
+
+    # Opening lines ("hi", "hello") dominate traffic and don't depend on prior turns, so their replies are shared
+    cache_key = response_cache_key(char['id'], session['current_style'], text) if len(history) == 1 else None
+
+    # The typing indicator and the Groq call are independent, so overlap them
+    _, response_text = await asyncio.gather(
+        send_typing(context.bot, chat_id),
+        generate_response(history, system_prompt, session['summary'], cache_key),
+    )
+
+    # Send the reply and save the assistant msg concurrently
+    await asyncio.gather(
+        tg_call(chat_id, update.message.reply_text, response_text),
+        update_chat_history(user_id, "assistant", response_text),
+    )
+
+    # Every 3rd message, refresh the summary of everything that leaves the Groq window before the next refresh.
+    # A long history with no summary yet (restored checkpoint, pre-summary session) is backfilled right away
+    needs_backfill = not session['summary'] and len(history) > GROQ_HISTORY_WINDOW
+    if needs_backfill or (len(history) > SUMMARY_KEEP_TURNS and session['msg_counter'] == 0):
+        spawn_background(summarize_history(user_id, session))
+
+    # Image Generation Logic (msg_counter wraps back to 0 every 3rd message; skipped if RunPod isn't set up)
+    if RUNPOD_CONFIGURED and session['msg_counter'] == 0:
+        # Fire-and-forget: the handler returns right after the text reply
+        spawn_background(_maybe_send_image(context.bot, chat_id, response_text, session, user_data))
 
 
 async def create_checkpoint_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    # Under the user lock so the save never captures a half-finished turn
+    async with user_lock(user_id):
+        session = await get_active_session(user_id)
+        if not session:
+            await tg_call(update.effective_chat.id, update.message.reply_text, "No active chat to save.")
+            return
 
-user_id = update.effective_user.id
-
-session = await get_active_session(user_id)
-
-if not session:
-
-await update.message.reply_text("No active chat to save.")
-
-return
-
-
-name = f"Save {datetime.now().strftime('%Y-%m-%d %H:%M')}"
-
-
-data = {
-
-"user_id": user_id,
-
-"character_id": session['character_id'],
-
-"checkpoint_name": name,
-
-"chat_history": session['chat_history'],
-
-"current_style": session['current_style']
-
-}
-
-supabase.table("checkpoints").insert(data).execute()
-
-await update.message.reply_text(f"✅ Game Saved: {name}")
+        name = f"Save {datetime.now().strftime('%Y-%m-%d %H:%M')}"
 
+        await create_checkpoint(user_id, session, name)
+    await tg_call(update.effective_chat.id, update.message.reply_text, f"✅ Game Saved: {name}")
 
 
 # --- CALLBACK QUERY HANDLER (Menus) ---
 
-
-
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-
-query = update.callback_query
-
-await query.answer() # This stops the button from "loading" forever
-
-data = query.data
-
-user_id = query.from_user.id
-
-
-# --- 1. CHARACTER MENU ---
-
-if data == "menu_chars":
-
-chars = supabase.table("characters").select("*").execute().data
-
-keyboard = []
-
-for c in chars:
-
-# Check if user is premium or if char is free
-
-is_premium_user = supabase.table("users").select("is_premium").eq("telegram_id", user_id).execute().data[0]['is_premium']
-
-lock = "🔒" if (not c['is_free'] and not is_premium_user) else "✨"
-
-keyboard.append([InlineKeyboardButton(f"{c['name']} {lock}", callback_data=f"select_char_{c['id']}")])
-
-
-await query.edit_message_text("Pick your date for tonight: 😘", reply_markup=InlineKeyboardMarkup(keyboard))
-
-
-# --- 2. SELECT CHARACTER ---
-
-elif data.startswith("select_char_"):
-
-char_id = data.split("_")[-1]
-
-
-# Check if locked
-
-char_data = supabase.table("characters").select("*").eq("id", char_id).execute().data[0]
-
-user_data = supabase.table("users").select("is_premium").eq("telegram_id", user_id).execute().data[0]
-
-
-if not char_data['is_free'] and not user_data['is_premium']:
-
-await query.message.reply_text("🔒 That character is for Premium users only! Upgrade to chat with her.")
-
-return
-
-
-
-# Start Session
-
-supabase.table("active_sessions").delete().eq("user_id", user_id).execute()
-
-supabase.table("active_sessions").insert({
-
-"user_id": user_id,
-
-"character_id": char_id,
-
-"current_style": "Realistic"
-
-}).execute()
-
-
-await query.edit_message_text(f"I'm ready for you... say hello to {char_data['name']}. 😉")
-
-
-
-# --- 3. CHECKPOINT MENU ---
-
-elif data == "menu_checkpoints":
-
-# Fetch saves from DB
-
-saves = supabase.table("checkpoints").select("*").eq("user_id", user_id).order("created_at", desc=True).execute().data
-
-
-if not saves:
-
-await query.edit_message_text("🚫 No saved games found.\nUse /checkpoint while chatting to save!")
-
-return
-
-
-keyboard = []
-
-for save in saves:
-
-# Create a button for each save file
-
-btn_text = f"📂 {save['checkpoint_name']} ({save['current_style']})"
-
-keyboard.append([InlineKeyboardButton(btn_text, callback_data=f"restore_{save['id']}")])
-
-
-await query.edit_message_text("Select a save file to load:", reply_markup=InlineKeyboardMarkup(keyboard))
-
-
-
-# --- 4. RESTORE CHECKPOINT ---
-
-elif data.startswith("restore_"):
-
-checkpoint_id = data.split("_")[1]
-
-save_data = supabase.table("checkpoints").select("*").eq("id", checkpoint_id).execute().data[0]
-
-
-# Restore into Active Session
-
-supabase.table("active_sessions").delete().eq("user_id", user_id).execute()
-
-supabase.table("active_sessions").insert({
-
-"user_id": user_id,
-
-"character_id": save_data['character_id'],
-
-"current_style": save_data['current_style'],
-
-"chat_history": save_data['chat_history']
-
-}).execute()
-
-
-await query.edit_message_text(f"✅ Memory Loaded: {save_data['checkpoint_name']}\nContinue where you left off!")
-
-
-
-# --- 5. PREMIUM MENU ---
-
-elif data == "menu_premium":
-
-# This sends the Stripe Payment Link
-
-# IMPORTANT: Replace the url below with your real Stripe Payment Link
-
-keyboard = [[InlineKeyboardButton("💳 Click to Pay $9.99", url="https://buy.stripe.com/test_12345")]]
-
-
-await query.message.reply_text(
-
-"💎 **Premium Access**\n\n"
-
-"🔥 Unlimited Messages\n"
-
-"📸 Unlimited Photos\n"
-
-"🔓 Unlock Raven (Goth Girl)\n\n"
-
-"Click below to upgrade:",
-
-reply_markup=InlineKeyboardMarkup(keyboard),
-
-parse_mode="Markdown"
-
-)
-
+    query = update.callback_query
+    await query.answer() # This stops the button from "loading" forever
+    data = query.data
+    user_id = query.from_user.id
+    chat_id = update.effective_chat.id
+
+    # --- 1. CHARACTER MENU ---
+    if data == "menu_chars":
+        chars = await get_characters()
+        is_premium = await is_premium_user(user_id)
+        keyboard = []
+        for c in chars:
+            # Check if user is premium or if char is free
+            lock = "🔒" if (not c['is_free'] and not is_premium) else "✨"
+            keyboard.append([InlineKeyboardButton(f"{c['name']} {lock}", callback_data=f"select_char_{c['id']}")])
+
+        await tg_call(chat_id, query.edit_message_text, "Pick your date for tonight: 😘", reply_markup=InlineKeyboardMarkup(keyboard))
+
+    # --- 2. SELECT CHARACTER ---
+    elif data.startswith("select_char_"):
+        char_id = data.split("_")[-1]
+
+        # Check if locked
+        char_data = next((c for c in await get_characters() if str(c['id']) == char_id), None)
+        if not char_data:
+            return
+
+        if not char_data['is_free'] and not await is_premium_user(user_id):
+            await tg_call(chat_id, query.message.reply_text, "🔒 That character is for Premium users only! Upgrade to chat with her.")
+            return
+
+        # Start Session (under the user lock so an in-flight message can't write into the new session)
+        async with user_lock(user_id):
+            await start_session(user_id, char_data['id'], "Realistic", [])
+
+        await tg_call(chat_id, query.edit_message_text, f"I'm ready for you... say hello to {char_data['name']}. 😉")
+
+    # --- 3. CHECKPOINT MENU ---
+    elif data == "menu_checkpoints":
+        # Fetch saves from DB
+        saves = await get_checkpoints(user_id)
+
+        if not saves:
+            await tg_call(chat_id, query.edit_message_text, "🚫 No saved games found.\nUse /checkpoint while chatting to save!")
+            return
+
+        keyboard = []
+        for save in saves:
+            # Create a button for each save file
+            btn_text = f"📂 {save['checkpoint_name']} ({save['current_style']})"
+            keyboard.append([InlineKeyboardButton(btn_text, callback_data=f"restore_{save['id']}")])
+
+        await tg_call(chat_id, query.edit_message_text, "Select a save file to load:", reply_markup=InlineKeyboardMarkup(keyboard))
+
+    # --- 4. RESTORE CHECKPOINT ---
+    elif data.startswith("restore_"):
+        checkpoint_id = data.split("_")[1]
+        save_data = await get_checkpoint(user_id, checkpoint_id)
+        if not save_data:
+            return
+
+        # Restore into Active Session (under the user lock, as above)
+        async with user_lock(user_id):
+            await start_session(user_id, save_data['character_id'], save_data['current_style'], save_data['chat_history'])
+
+        await tg_call(chat_id, query.edit_message_text, f"✅ Memory Loaded: {save_data['checkpoint_name']}\nContinue where you left off!")
+
+    # --- 5. PREMIUM MENU ---
+    elif data == "menu_premium":
+        # This sends the Stripe Payment Link (see STRIPE_PAYMENT_LINK)
+        await tg_call(
+            chat_id, query.message.reply_text,
+            PREMIUM_TEXT,
+            reply_markup=PREMIUM_KEYBOARD,
+            parse_mode="Markdown"
+        )
+
+
+# --- TELEGRAM BOT ---
+
+def build_bot():
+    """Builds the Telegram Bot"""
+    bot_app = (
+        Application.builder()
+        .token(TOKEN)
+        .updater(None) # Updates arrive via webhook
+        .concurrent_updates(True) # Different users in parallel; handle_message serializes per user
+        .build()
+    )
+    bot_app.add_handler(CommandHandler("start", start))
+    bot_app.add_handler(CommandHandler("checkpoint", create_checkpoint_command))
+    bot_app.add_handler(CallbackQueryHandler(button_handler))
+    bot_app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    return bot_app
 
 
 # --- FASTAPI SERVER (Webhooks) ---
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Opens the Postgres pool and HTTP client once per process, then runs the bot alongside the server"""
+    global db_pool, http_client, bot_app
+    if not TELEGRAM_WEBHOOK_SECRET or not PUBLIC_URL:
+        raise RuntimeError("TELEGRAM_WEBHOOK_SECRET and PUBLIC_URL must be set to receive Telegram updates")
+
+    db_pool = await asyncpg.create_pool(
+        DATABASE_URL,
+        min_size=min(10, DB_POOL_MAX_SIZE),
+        max_size=DB_POOL_MAX_SIZE,
+        max_inactive_connection_lifetime=300, # Recycle idle connections before the pooler drops them
+        # Supavisor/PgBouncer in transaction mode hands each statement to any backend, so named
+        # prepared statements break; with the cache off asyncpg only uses unnamed ones
+        # JIT is disabled on the role instead (migrations/005): poolers reject or don't forward startup settings
+        statement_cache_size=0,
+        init=init_db_connection,
+    )
+    http_client = httpx.AsyncClient(
+        http2=True,
+        timeout=60,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+    )
+
+    bot_app = build_bot()
+    await bot_app.initialize()
+    await bot_app.start()
+    await bot_app.bot.set_webhook(
+        url=f"{PUBLIC_URL}/telegram/{TELEGRAM_WEBHOOK_SECRET}",
+        secret_token=TELEGRAM_WEBHOOK_SECRET, # Echoed back in X-Telegram-Bot-Api-Secret-Token
+    )
+    try:
+        yield
+    finally:
+        await bot_app.stop()
+        await bot_app.shutdown()
+        await http_client.aclose()
+        await db_pool.close()
+
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+
+
+@app.post("/telegram/{secret}")
+async def telegram_webhook(secret: str, request: Request):
+    # Compare bytes: compare_digest rejects non-ASCII str, which would turn a bad request into a 500
+    expected = TELEGRAM_WEBHOOK_SECRET.encode()
+    header = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not (secrets.compare_digest(secret.encode(), expected) and secrets.compare_digest(header.encode(), expected)):
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+    update = Update.de_json(orjson.loads(await request.body()), bot_app.bot)
+    await bot_app.update_queue.put(update)
+    return {"status": "success"}
 
 
 @app.post("/stripe_webhook")
-
 async def stripe_webhook(request: Request):
+    payload = await request.body()
+    sig_header = request.headers.get('STRIPE_SIGNATURE')
 
-payload = await request.body()
-
-sig_header = request.headers.get('STRIPE_SIGNATURE')
-
-
-try:
-
-event = stripe.Webhook.construct_event(payload, sig_header, STRIPE_WEBHOOK_SECRET)
-
-except Exception as e:
-
-raise HTTPException(status_code=400, detail=str(e))
+    try:
+        event = stripe.Webhook.construct_event(payload, sig_header, STRIPE_WEBHOOK_SECRET)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
+    if event['type'] == 'checkout.session.completed':
+        session = event['data']['object']
+        # Metadata should contain telegram_id
+        tg_id = session.get('metadata', {}).get('telegram_id')
+        if tg_id:
+            supabase.table("users").update({"is_premium": True}).eq("telegram_id", tg_id).execute()
+            PREMIUM_CACHE.pop(premium_cache_key(tg_id), None)
 
-if event['type'] == 'checkout.session.completed':
-
-session = event['data']['object']
-
-# Metadata should contain telegram_id
-
-tg_id = session.get('metadata', {}).get('telegram_id')
-
-if tg_id:
-
-supabase.table("users").update({"is_premium": True}).eq("telegram_id", tg_id).execute()
-
-
-return {"status": "success"}
-
+    return {"status": "success"}
 
 
 @app.get("/")
-
 def health_check():
-
-return {"status": "online", "service": "Girlfriend Bot"}
-
+    return {"status": "online", "service": "Girlfriend Bot"}
 
 
 # --- MAIN ENTRY POINT ---
 
-
-
-async def run_bot():
-
-"""Runs the Telegram Bot"""
-
-app = Application.builder().token(TOKEN).build()
-
-app.add_handler(CommandHandler("start", start))
-
-app.add_handler(CommandHandler("checkpoint", create_checkpoint_command))
-
-app.add_handler(CallbackQueryHandler(button_handler))
-
-app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
-
-
-await app.initialize()
-
-await app.start()
-
-await app.updater.start_polling() # Polling is easiest for non-server setups
-
-
-# Keep running until cancelled
-
-try:
-
-while True:
-
-await asyncio.sleep(3600)
-
-except asyncio.CancelledError:
-
-await app.updater.stop()
-
-await app.stop()
-
-
-
-# Combine FastAPI and Bot
-
+# Combine FastAPI and Bot: the bot runs inside the ASGI lifespan (see lifespan)
 if __name__ == "__main__":
-
-# Create event loop
-
-loop = asyncio.new_event_loop()
-
-asyncio.set_event_loop(loop)
-
-
-# Start Bot in background
-
-loop.create_task(run_bot())
-
-
-# Start FastAPI Server
-
-config = uvicorn.Config(app=app, host="0.0.0.0", port=8000, loop=loop)
-
-server = uvicorn.Server(config)
-
-loop.run_until_complete(server.serve())
+    # log_config=None keeps uvicorn's loggers on the root queue handler instead of its own stream handlers
+    uvicorn.run(app, host="0.0.0.0", port=8000, loop="uvloop", http="httptools", log_config=None)
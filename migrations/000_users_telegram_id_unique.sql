@@ -0,0 +1,6 @@
+-- get_or_create_user upserts with ON CONFLICT (telegram_id), which needs a unique
+-- index on users.telegram_id (redundant if telegram_id is already the primary key).
+-- CREATE INDEX CONCURRENTLY cannot run inside a transaction block.
+
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS users_telegram_id_idx
+    ON users (telegram_id);
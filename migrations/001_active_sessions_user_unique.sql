@@ -0,0 +1,11 @@
+-- One active session per user; lets start_session replace it with a single
+-- INSERT ... ON CONFLICT (user_id) DO UPDATE instead of DELETE + INSERT.
+
+-- Drop duplicates left behind by the old DELETE + INSERT flow, keeping the newest row
+DELETE FROM active_sessions a
+USING active_sessions b
+WHERE a.user_id = b.user_id
+  AND a.ctid < b.ctid;
+
+ALTER TABLE active_sessions
+    ADD CONSTRAINT active_sessions_user_id_key UNIQUE (user_id);
@@ -0,0 +1,16 @@
+-- get_or_create_user compares last_reset_time against now() in SQL, so store it
+-- as an absolute instant. Existing naive values were written in UTC. The type change
+-- only runs if the column is still timestamp without time zone, so re-running this
+-- (or running it on an already-migrated table) doesn't rewrite the table.
+
+DO $$
+BEGIN
+    IF (SELECT data_type FROM information_schema.columns
+        WHERE table_schema = 'public' AND table_name = 'users' AND column_name = 'last_reset_time')
+        = 'timestamp without time zone' THEN
+        ALTER TABLE users
+            ALTER COLUMN last_reset_time TYPE timestamptz USING last_reset_time AT TIME ZONE 'UTC';
+    END IF;
+END $$;
+
+ALTER TABLE users ALTER COLUMN last_reset_time SET DEFAULT now();
@@ -0,0 +1,14 @@
+-- Indexes for the lookups every handler makes. CREATE INDEX CONCURRENTLY avoids
+-- locking the tables but cannot run inside a transaction block, so run this file
+-- statement by statement (e.g. psql without --single-transaction).
+--
+-- users(telegram_id) is covered by the unique index from 000 and
+-- active_sessions(user_id) by the unique constraint from 001.
+
+-- Checkpoint menu: WHERE user_id = $1 ORDER BY created_at DESC
+CREATE INDEX CONCURRENTLY IF NOT EXISTS checkpoints_user_id_created_at_idx
+    ON checkpoints (user_id, created_at DESC);
+
+-- Free characters
+CREATE INDEX CONCURRENTLY IF NOT EXISTS characters_is_free_idx
+    ON characters (is_free) WHERE is_free;
@@ -0,0 +1,5 @@
+-- Rolling summary of the turns that fall outside the window sent to Groq
+-- (see summarize_history). Cleared whenever a session is started or restored.
+
+ALTER TABLE active_sessions
+    ADD COLUMN IF NOT EXISTS summary text;
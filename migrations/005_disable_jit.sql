@@ -0,0 +1,7 @@
+-- JIT compilation only adds latency to the bot's short OLTP queries. It is set on the
+-- role rather than as an asyncpg startup parameter: PgBouncer rejects unknown startup
+-- parameters (unless listed in ignore_startup_parameters), and in transaction mode a
+-- startup setting isn't guaranteed to reach the backend that runs a given statement.
+-- Replace "postgres" with the role DATABASE_URL connects as; applies to new sessions.
+
+ALTER ROLE postgres SET jit = off;